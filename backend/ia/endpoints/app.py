@@ -8,7 +8,12 @@ import os, numpy as np, joblib, pandas as pd
 from sqlalchemy import create_engine, text
 from sentence_transformers import SentenceTransformer
 from sklearn.linear_model import Ridge
-import importlib, uuid
+import importlib, uuid, threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ..utils.encoding import encode_texts
+from ..utils.curriculum import refresh_curriculum, estandar_attrs
+from ..utils.schema import list_tables, list_columns, find_table, find_column
 
 app = FastAPI(title="Adaptive IA")
 
@@ -19,65 +24,68 @@ MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
 ART_DIR = Path(__file__).resolve().parent.parent / "models"
 ART_DIR.mkdir(parents=True, exist_ok=True)
 
-_reg = None  # Ridge
-_X = None    # embeddings np.ndarray
-_df = None   # question_index DataFrame
+# Artefactos de entrenamiento de una misma generación, publicados como una sola tupla
+# (reg, X, pred, df, vals) para que los hilos de /rank y del precalculo nunca mezclen:
+#   reg  Ridge, X embeddings, pred dificultad predicha alineada con df,
+#   df   question_index, vals id_materia -> valores de estándar ordenados (únicos)
+_artifacts = None
+_artifacts_lock = threading.Lock()
 
 def load_artifacts():
-    """Carga perezosa de los artefactos de entrenamiento."""
-    global _reg, _X, _df
-    if _reg is None:
-        _reg = joblib.load(ART_DIR / "difficulty_reg.pkl")
-    if _X is None:
-        _X = np.load(ART_DIR / "embeddings.npy")
-    if _df is None:
-        _df = pd.read_json(ART_DIR / "question_index.json")
+    """Carga perezosa de los artefactos de entrenamiento; devuelve la tupla completa."""
+    global _artifacts
+    arts = _artifacts
+    if arts is not None:
+        return arts
+    with _artifacts_lock:
+        if _artifacts is None:
+            try:
+                reg = joblib.load(ART_DIR / "difficulty_reg.pkl")
+                X = np.load(ART_DIR / "embeddings.npy")
+                df = pd.read_json(ART_DIR / "question_index.json")
+            except FileNotFoundError:
+                raise RuntimeError("Modelos no entrenados. Ejecuta /retrain primero.")
+            vals = df["valor_estandar"].astype(float)
+            vals = {int(m): np.unique(v[np.isfinite(v)]) for m, v in vals.groupby(df["id_materia"])}
+            _artifacts = (reg, X, reg.predict(X), df, vals)
+        return _artifacts
+
+def _materia_range(vals: Dict[int, np.ndarray], id_materia: int) -> Optional[Tuple[float, float]]:
+    """(vmin, vmax) de valor_estandar en la materia, o None si no hay rango válido."""
+    v = vals.get(int(id_materia))
+    if v is None or v.size == 0 or v[-1] <= v[0]:
+        return None
+    return float(v[0]), float(v[-1])
 
 # =========================
 # Health
 # =========================
 @app.get("/health")
 def health():
-    return {"ok": True}
+    with _prefetch_lock:
+        stats = {**PREFETCH_STATS, "pending": _prefetch_pending}
+    return {"ok": True, "prefetch": stats}
 
 # =========================
-# Helpers: tablas / columnas (case-insensitive)
+# Helpers
 # =========================
-def list_tables(con) -> list[str]:
-    return pd.read_sql(
-        "SELECT table_name FROM information_schema.tables WHERE table_schema='public'",
-        con
-    )["table_name"].tolist()
-
-def list_columns(con, table_name: str) -> list[str]:
-    return pd.read_sql(
-        "SELECT column_name FROM information_schema.columns WHERE table_schema='public' AND table_name = %(t)s",
-        con, params={"t": table_name}
-    )["column_name"].tolist()
-
-def find_table(con, base: str) -> str | None:
-    for n in list_tables(con):
-        if n.lower() == base.lower():
-            return n
-    return None
-
-def find_column(con, table_name: str, base: str) -> str | None:
-    for c in list_columns(con, table_name):
-        if c.lower() == base.lower():
-            return c
-    return None
-
 def _scale01(s: pd.Series) -> pd.Series:
     vmin, vmax = s.min(), s.max()
     if pd.isna(vmin) or pd.isna(vmax) or vmax <= vmin:
         return pd.Series([0.5] * len(s), index=s.index)
     return (s - vmin) / (vmax - vmin)
 
+_engine_cache = None
+
 def _engine():
-    url = os.getenv("DATABASE_URL")
-    if not url:
-        raise RuntimeError("DATABASE_URL no configurado")
-    return create_engine(url, pool_pre_ping=True)
+    """Engine compartido (con su pool de conexiones) para todo el proceso."""
+    global _engine_cache
+    if _engine_cache is None:
+        url = os.getenv("DATABASE_URL")
+        if not url:
+            raise RuntimeError("DATABASE_URL no configurado")
+        _engine_cache = create_engine(url, pool_pre_ping=True)
+    return _engine_cache
 
 # =========================
 # Diagnóstico rápido
@@ -152,15 +160,9 @@ def retrain():
             # Tablas reales
             preg_table = find_table(con, "pregunta")
             resp_table = find_table(con, "respuesta")
-            estd_table = find_table(con, "estandar")
-            tema_table = find_table(con, "tema")
-            area_table = find_table(con, "area")
 
-            if not (preg_table and estd_table and tema_table and area_table):
-                faltan = [n for n, v in {
-                    "pregunta": preg_table, "estandar": estd_table, "tema": tema_table, "area": area_table
-                }.items() if not v]
-                return {"trained": False, "msg": f"Faltan tablas: {', '.join(faltan)}", "n_questions": 0}
+            if not preg_table:
+                return {"trained": False, "msg": "Faltan tablas: pregunta", "n_questions": 0}
 
             # Columnas por tabla
             # Pregunta
@@ -169,42 +171,34 @@ def retrain():
             p_id_estandar = find_column(con, preg_table, "id_estandar") or "id_estandar"
             p_activa      = find_column(con, preg_table, "activa")      or "activa"
 
-            # Estandar
-            e_id_estandar = find_column(con, estd_table, "id_estandar") or "id_estandar"
-            e_id_tema     = find_column(con, estd_table, "id_tema")     or "id_tema"
-            e_valor       = find_column(con, estd_table, "valor")       or "valor"
-
-            # Tema
-            t_id_tema     = find_column(con, tema_table, "id_tema")     or "id_tema"
-            t_id_area     = find_column(con, tema_table, "id_area")     or "id_area"
-
-            # Area
-            a_id_area     = find_column(con, area_table, "id_area")     or "id_area"
-            a_id_materia  = find_column(con, area_table, "id_materia")  or "id_materia"
-
-            # 1) Preguntas activas + valor del estándar + id_materia
+            # 1) Preguntas activas; valor del estándar e id_materia salen de la jerarquía cacheada
             q = f'''
                 SELECT
                     p."{p_id_pregunta}" AS id_pregunta,
                     p."{p_enunciado}"   AS enunciado,
-                    e."{e_valor}"       AS valor_estandar,
-                    a."{a_id_materia}"  AS id_materia
+                    p."{p_id_estandar}" AS id_estandar
                 FROM "{preg_table}" p
-                JOIN "{estd_table}" e ON e."{e_id_estandar}" = p."{p_id_estandar}"
-                JOIN "{tema_table}" t  ON e."{e_id_tema}"    = t."{t_id_tema}"
-                JOIN "{area_table}" a  ON t."{t_id_area}"    = a."{a_id_area}"
                 WHERE p."{p_activa}" = TRUE
                 ORDER BY p."{p_id_pregunta}"
             '''
             df = pd.read_sql(text(q), con)
 
+        try:
+            cur = refresh_curriculum(engine)  # valida estandar / tema / area
+        except RuntimeError as ex:
+            return {"trained": False, "msg": str(ex), "n_questions": 0}
+        id_est = pd.to_numeric(df["id_estandar"], errors="coerce").fillna(-1).astype(np.int64).to_numpy()
+        valor, materia = estandar_attrs(cur, id_est)
+        df = df.assign(valor_estandar=valor, id_materia=materia)
+        df = df[df["id_materia"] >= 0].drop(columns="id_estandar").reset_index(drop=True)
+
         n = int(df.shape[0])
         if n == 0:
             return {"trained": True, "n_questions": 0, "msg": f'No hay preguntas activas en "{preg_table}"'}
 
         # 2) Embeddings BERT
         mdl = SentenceTransformer(MODEL_NAME)
-        X = mdl.encode(df["enunciado"].tolist(), convert_to_numpy=True, normalize_embeddings=True)
+        X = encode_texts(mdl, df["enunciado"].tolist(), progress=True)
 
         # 3) Objetivo de dificultad con historial si existe:
         acc_map = {}
@@ -243,8 +237,11 @@ def retrain():
         )
 
         # limpia el cache en memoria para que /rank cargue lo nuevo
-        global _reg, _X, _df
-        _reg = _X = _df = None
+        global _artifacts
+        with _artifacts_lock:
+            _artifacts = None
+        for sess in list(SESSIONS.values()):
+            _drop_prefetch(sess)
 
         return {"trained": True, "n_questions": n, "sin_historial": int(len(acc_map) == 0)}
 
@@ -256,6 +253,15 @@ def retrain():
             content={"trained": False, "error": str(e), "trace": tb[-2000:]}
         )
 
+@app.post("/curriculum/refresh")
+def curriculum_refresh():
+    """Recarga la jerarquía ESTANDAR → TEMA → AREA → materia sin reentrenar."""
+    try:
+        cur = refresh_curriculum(_engine())
+        return {"ok": True, "estandares": cur["n_estandares"]}
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"ok": False, "msg": str(e)})
+
 # =========================
 # Rank: sugiere la(s) siguiente(s) pregunta(s)
 # =========================
@@ -266,26 +272,22 @@ class RankRequest(BaseModel):
     k: int = 1                  # cuántas devolver
 
 def _rank_impl(id_materia: int, target_valor: float, exclude: List[int], k: int = 1):
-    load_artifacts()
-    if _df is None or _X is None or _reg is None:
-        raise RuntimeError("Modelos no entrenados. Ejecuta /retrain primero.")
-
-    df = _df.copy()
+    _, _, pred, df, vals = load_artifacts()
     dfm = df[df["id_materia"] == id_materia]
     if dfm.empty:
         return {"target": None, "items": []}
 
-    vmin, vmax = float(dfm["valor_estandar"].min()), float(dfm["valor_estandar"].max())
-    if not np.isfinite(vmin) or not np.isfinite(vmax) or vmax <= vmin:
+    rng = _materia_range(vals, id_materia)
+    if rng is None:
         vnorm = 0.5
     else:
+        vmin, vmax = rng
         vnorm = (target_valor - vmin) / (vmax - vmin)
         vnorm = float(np.clip(vnorm, 0.0, 1.0))
 
     target = 0.35 + 0.65 * vnorm
 
-    preds = _reg.predict(_X)  # alineado con _df
-    sub = df.assign(pred=preds)
+    sub = df.assign(pred=pred)  # alineado con df
     sub = sub[sub["id_materia"] == id_materia]
 
     if exclude:
@@ -369,9 +371,20 @@ SESSIONS: Dict[str, Dict[str, Any]] = {}
 #   "num_preg_max": int,
 #   "exclude": List[int],
 #   "shown": int,
-#   "last_target": float
+#   "last_target": float,
+#   "prefetch": {"key": frozenset, "futures": {target: Future}}   (opcional)
 # }
 
+# Precalculo especulativo de la siguiente pregunta (ranking + opciones de BD)
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "4"))
+PREFETCH_PER_SESSION = int(os.getenv("PREFETCH_PER_SESSION", "3"))       # targets por sesión
+PREFETCH_MAX_PENDING = int(os.getenv("PREFETCH_MAX_PENDING", str(4 * PREFETCH_WORKERS)))  # en total
+PREFETCH_WAIT_S = float(os.getenv("PREFETCH_WAIT_S", "0.05"))  # espera máx. a un precalculo en curso
+_PREFETCH_POOL = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+PREFETCH_STATS = {"hits": 0, "misses": 0, "skipped": 0}
+_prefetch_lock = threading.Lock()
+_prefetch_pending = 0
+
 class StartBody(BaseModel):
     carne_estudiante: str | int
     id_materia: int
@@ -385,14 +398,10 @@ class AnswerBody(BaseModel):
 
 def _initial_target_for_materia(id_materia: int) -> float:
     """Usa el rango real de 'valor_estandar' para elegir un target medio crudo."""
-    load_artifacts()
-    dfm = _df[_df["id_materia"] == id_materia]
-    if dfm.empty:
-        return 0.5
-    vmin, vmax = float(dfm["valor_estandar"].min()), float(dfm["valor_estandar"].max())
-    if not np.isfinite(vmin) or not np.isfinite(vmax) or vmax <= vmin:
+    rng = _materia_range(load_artifacts()[4], id_materia)
+    if rng is None:
         return 0.5
-    return 0.5 * (vmin + vmax)
+    return 0.5 * (rng[0] + rng[1])
 
 def _question_payload(pid: int, enunciado: str, id_materia: int) -> Dict[str, Any]:
     """Adjunta opciones desde BD y normaliza payload."""
@@ -408,6 +417,97 @@ def _question_payload(pid: int, enunciado: str, id_materia: int) -> Dict[str, An
         "opciones": opciones,
     }
 
+def _next_question(id_materia: int, target: float, exclude: List[int]) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """Rank + payload de la siguiente pregunta; None si ya no quedan."""
+    out = _rank_impl(id_materia, target, exclude=exclude, k=1)
+    items = out.get("items", [])
+    if not items:
+        return None
+    q = items[0]
+    return q, _question_payload(q["id_pregunta"], q["enunciado"], id_materia)
+
+def _candidate_targets(id_materia: int, valor: float) -> List[float]:
+    """
+    Targets probables tras la pregunta servida: mismo valor (NEXT / se mantiene)
+    y el valor de estándar inmediato superior e inferior (acierto / fallo).
+    """
+    vals = load_artifacts()[4].get(int(id_materia), np.zeros(0))
+    up, down = vals[vals > valor], vals[vals < valor]
+    out = [float(valor)]
+    if up.size:
+        out.append(float(up[0]))
+    if down.size:
+        out.append(float(down[-1]))
+    return out
+
+def _count(stat: str) -> None:
+    with _prefetch_lock:
+        PREFETCH_STATS[stat] += 1
+
+def _prefetch_done(_fut) -> None:
+    global _prefetch_pending
+    with _prefetch_lock:
+        _prefetch_pending -= 1
+
+def _submit_prefetch(id_materia: int, target: float, exclude: List[int]):
+    """Encola un precalculo si no se supera el tope global; None si se descarta."""
+    global _prefetch_pending
+    with _prefetch_lock:
+        if _prefetch_pending >= PREFETCH_MAX_PENDING:
+            PREFETCH_STATS["skipped"] += 1
+            return None
+        _prefetch_pending += 1
+    fut = _PREFETCH_POOL.submit(_next_question, id_materia, target, exclude)
+    fut.add_done_callback(_prefetch_done)  # también se dispara al cancelar
+    return fut
+
+def _drop_prefetch(sess: Dict[str, Any], keep=None) -> None:
+    """Quita el precalculo de la sesión y cancela todo future distinto de `keep`."""
+    pf = sess.pop("prefetch", None)
+    if pf:
+        for fut in pf["futures"].values():
+            if fut is not keep:
+                fut.cancel()
+
+def _schedule_prefetch(sess: Dict[str, Any]) -> None:
+    """Lanza en segundo plano el cálculo de las siguientes preguntas posibles."""
+    _drop_prefetch(sess)
+    if sess["shown"] >= sess["num_preg_max"]:
+        return
+    exclude = list(sess["exclude"])
+    try:
+        targets = _candidate_targets(sess["id_materia"], sess["last_target"])[:PREFETCH_PER_SESSION]
+    except Exception:
+        return
+    futures = {}
+    for t in targets:
+        fut = _submit_prefetch(sess["id_materia"], t, exclude)
+        if fut is None:
+            break
+        futures[t] = fut
+    if futures:
+        sess["prefetch"] = {"key": frozenset(exclude), "futures": futures}
+
+def _resolve_next(sess: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """Usa el precalculo si coincide con el estado actual; si no, calcula en línea."""
+    pf = sess.get("prefetch")
+    target = float(sess["last_target"])
+    fut = None
+    if pf and pf["key"] == frozenset(sess["exclude"]):
+        fut = pf["futures"].get(target)
+    _drop_prefetch(sess, keep=fut)
+    # Solo sirve si ya terminó o está corriendo y termina pronto; si sigue en cola
+    # detrás de otras sesiones, es más rápido calcular en línea.
+    if fut is not None and not fut.cancel():
+        try:
+            res = fut.result(timeout=0 if fut.done() else PREFETCH_WAIT_S)
+            _count("hits")
+            return res
+        except Exception:
+            pass
+    _count("misses")
+    return _next_question(sess["id_materia"], target, sess["exclude"])
+
 # =========================
 # Endpoints de sesión adaptativa
 # =========================
@@ -421,13 +521,11 @@ def session_start(body: StartBody):
         target = _initial_target_for_materia(body.id_materia)
 
         # Elige 1ra pregunta
-        out = _rank_impl(body.id_materia, target, exclude=[], k=1)
-        items = out.get("items", [])
-        if not items:
+        res = _next_question(body.id_materia, target, [])
+        if res is None:
             return {"ok": True, "session_id": sid, "question": None, "msg": "Sin preguntas disponibles para la materia."}
 
-        q = items[0]
-        payload = _question_payload(q["id_pregunta"], q["enunciado"], body.id_materia)
+        q, payload = res
 
         # Guarda sesión
         SESSIONS[sid] = {
@@ -438,6 +536,7 @@ def session_start(body: StartBody):
             "shown": 1,
             "last_target": float(q["valor_estandar"]),  # o usa 'out["target"]'
         }
+        _schedule_prefetch(SESSIONS[sid])
 
         return {"ok": True, "session_id": sid, "question": payload}
     except Exception as e:
@@ -458,17 +557,15 @@ def session_next(sid: str, student_id: Optional[str | int] = Query(None, alias="
         if sess["shown"] >= sess["num_preg_max"]:
             return {"ok": True, "question": None, "finished": True}
 
-        out = _rank_impl(sess["id_materia"], sess["last_target"], exclude=sess["exclude"], k=1)
-        items = out.get("items", [])
-        if not items:
+        res = _resolve_next(sess)
+        if res is None:
             return {"ok": True, "question": None, "finished": True}
 
-        q = items[0]
-        payload = _question_payload(q["id_pregunta"], q["enunciado"], sess["id_materia"])
-
+        q, payload = res
         sess["exclude"].append(int(q["id_pregunta"]))
         sess["shown"] += 1
         sess["last_target"] = float(q["valor_estandar"])
+        _schedule_prefetch(sess)
 
         return {"ok": True, "question": payload}
     except Exception as e:
@@ -503,17 +600,15 @@ def session_answer(sid: str, body: AnswerBody):
             return {"ok": True, "question": None, "finished": True}
 
         # Calcula siguiente
-        out = _rank_impl(sess["id_materia"], sess["last_target"], exclude=sess["exclude"], k=1)
-        items = out.get("items", [])
-        if not items:
+        res = _resolve_next(sess)
+        if res is None:
             return {"ok": True, "question": None, "finished": True}
 
-        q = items[0]
-        payload = _question_payload(q["id_pregunta"], q["enunciado"], sess["id_materia"])
-
+        q, payload = res
         sess["exclude"].append(int(q["id_pregunta"]))
         sess["shown"] += 1
         sess["last_target"] = float(q["valor_estandar"])
+        _schedule_prefetch(sess)
 
         return {"ok": True, "question": payload}
     except Exception as e:
@@ -526,8 +621,9 @@ def session_end(sid: str):
     Finaliza manualmente una sesión adaptativa.
     """
     try:
-        if sid in SESSIONS:
-            del SESSIONS[sid]
+        sess = SESSIONS.pop(sid, None)
+        if sess:
+            _drop_prefetch(sess)
         return {"ok": True, "ended": True}
     except Exception as e:
         import traceback
@@ -1,18 +1,93 @@
-import os, json
+import os, json, threading
 import numpy as np
 from fastapi import FastAPI
 from pydantic import BaseModel
 from sentence_transformers import SentenceTransformer
 import uvicorn
+from utils.centroids import STATE_FILE, load_state, state_embedder, centroid_matrix
+from utils.embcache import encode_cached, cache_stats
 
 MODEL_DIR = os.getenv("MODEL_DIR", "./models/bert-es-v0-centroids")
+STATE_PATH = os.path.join(MODEL_DIR, STATE_FILE)
 
 with open(os.path.join(MODEL_DIR, "meta.json"), "r", encoding="utf-8") as f:
   META = json.load(f)
-with open(os.path.join(MODEL_DIR, "centroids.json"), "r", encoding="utf-8") as f:
-  CENTROIDS = {k: np.array(v, dtype=np.float32) for k, v in json.load(f).items()}
 
-EMBEDDER = SentenceTransformer(META["embedder_name"])
+def _startup_embedder():
+  # con estado binario, el embedder es el guardado junto a los centroides
+  try:
+    return state_embedder(load_state(STATE_PATH))
+  except (OSError, ValueError):
+    return META["embedder_name"]
+
+_name = _startup_embedder()
+# Modelo activo: (nombre del embedder, embedder, ids de estándar, centroides normalizados
+# por fila). Se reemplaza entero para que cada predicción use centroides y embedder del
+# mismo espacio de embeddings.
+ACTIVE = (_name, SentenceTransformer(_name), [], np.zeros((0, 0), dtype=np.float32))
+_state_mtime = None
+_reload_lock = threading.Lock()
+
+def _normalized(mat):
+  norms = np.linalg.norm(mat, axis=1, keepdims=True)
+  norms[norms == 0] = 1.0
+  return (mat / norms).astype(np.float32)
+
+def _activate(embedder_name, ids, mat):
+  """Publica centroides nuevos; recarga el embedder si el entrenamiento usó otro."""
+  global ACTIVE, META
+  name, embedder = ACTIVE[0], ACTIVE[1]
+  if embedder_name != name:
+    try:
+      embedder = SentenceTransformer(embedder_name)
+    except Exception as ex:
+      print(f"[WARN] No se pudo cargar el embedder {embedder_name!r}; se mantienen los centroides actuales:", ex)
+      return False
+    print(f"[INFO] Embedder cambiado: {name} -> {embedder_name}")
+    name = embedder_name
+  if mat.shape[1] != embedder.get_sentence_embedding_dimension():
+    print(f"[WARN] Dimensión de centroides ({mat.shape[1]}) distinta a la del embedder {name!r}; recarga rechazada")
+    return False
+  ACTIVE = (name, embedder, list(ids), _normalized(mat))
+  try:
+    META = _read_meta()  # solo informativo (trained_at, conteos)
+  except (OSError, ValueError):
+    pass
+  return True
+
+def _read_meta():
+  with open(os.path.join(MODEL_DIR, "meta.json"), "r", encoding="utf-8") as f:
+    return json.load(f)
+
+def load_centroids(force=False):
+  """Recarga el estado binario si cambió en disco (sin reiniciar el servicio)."""
+  global _state_mtime
+  if not os.path.exists(STATE_PATH):
+    if not ACTIVE[2]:
+      # Compatibilidad con modelos antiguos en JSON
+      with open(os.path.join(MODEL_DIR, "centroids.json"), "r", encoding="utf-8") as f:
+        data = json.load(f)
+      _activate(META["embedder_name"], data.keys(), np.array(list(data.values()), dtype=np.float32))
+    return False
+  mtime = os.stat(STATE_PATH).st_mtime_ns
+  if not force and mtime == _state_mtime:
+    return False
+  with _reload_lock:
+    if not force and mtime == _state_mtime:
+      return False
+    # el embedder sale del mismo archivo que los centroides, nunca de meta.json
+    try:
+      state = load_state(STATE_PATH)
+    except ValueError as ex:
+      print("[WARN]", ex)
+      ok = False
+    else:
+      ok = _activate(state_embedder(state), *centroid_matrix(state))
+    # aunque se rechace, no se reintenta en cada request hasta que cambie el archivo
+    _state_mtime = mtime
+  return ok
+
+load_centroids()
 
 app = FastAPI(title="SomaEdu IA - Baseline")
 
@@ -20,22 +95,24 @@ class Item(BaseModel):
   enunciado: str
   topk: int = 1
 
-def cosine_sim(a, b):
-  return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
-
 @app.get("/health")
 def health():
-  return {"ok": True, "estandares": len(CENTROIDS)}
+  load_centroids()
+  return {"ok": True, "estandares": len(ACTIVE[2]), "embedder": ACTIVE[0], "trained_at": META.get("trained_at"), "emb_cache": cache_stats()}
+
+@app.post("/reload")
+def reload():
+  return {"ok": True, "reloaded": load_centroids(force=True), "estandares": len(ACTIVE[2])}
 
 @app.post("/predict/estandar")
 def predict_estandar(item: Item):
-  vec = EMBEDDER.encode([item.enunciado], normalize_embeddings=True, convert_to_numpy=True)[0]
-  sims = []
-  for est, cen in CENTROIDS.items():
-    sims.append((est, cosine_sim(vec, cen)))
-  sims.sort(key=lambda x: x[1], reverse=True)
-  topk = max(1, int(item.topk))
-  out = [{"id_estandar": est, "similitud": round(sim, 4)} for est, sim in sims[:topk]]
+  load_centroids()
+  _, embedder, ids, mat = ACTIVE
+  vec = encode_cached(embedder, [item.enunciado])[0]
+  sims = mat @ vec.astype(np.float32)
+  topk = min(max(1, int(item.topk)), len(ids))
+  order = np.argsort(-sims, kind="stable")[:topk]
+  out = [{"id_estandar": ids[i], "similitud": round(float(sims[i]), 4)} for i in order]
   return {"predicciones": out}
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+# ia/utils/centroids.py
+import os, hashlib
+import numpy as np
+
+# Estado binario: sumas y conteos por estándar + embedding de cada ítem,
+# para poder restar ítems modificados o eliminados sin re-codificar el banco.
+# El nombre del embedder viaja en el mismo archivo: centroides y espacio de
+# embeddings nunca pueden quedar desparejados.
+STATE_FILE = "centroids.npz"
+_KEYS = ("embedder_name", "est_ids", "sums", "counts", "item_ids", "item_est", "item_hash", "item_embs")
+
+def text_hash(texto) -> str:
+    return hashlib.sha1(("" if texto is None else str(texto)).encode("utf-8")).hexdigest()
+
+def empty_state(dim: int, embedder_name: str):
+    return {
+        "embedder_name": np.array(embedder_name),
+        "est_ids": np.array([], dtype=str),
+        "sums": np.zeros((0, dim), dtype=np.float64),
+        "counts": np.zeros(0, dtype=np.int64),
+        "item_ids": np.zeros(0, dtype=np.int64),
+        "item_est": np.array([], dtype=str),
+        "item_hash": np.array([], dtype=str),
+        "item_embs": np.zeros((0, dim), dtype=np.float32),
+    }
+
+def load_state(path):
+    with np.load(path, allow_pickle=False) as z:
+        if "embedder_name" not in z.files:
+            raise ValueError(f"{path} no indica el embedder; reentrena sin --update")
+        return {k: z[k] for k in _KEYS}
+
+def state_embedder(state) -> str:
+    return str(state["embedder_name"])
+
+def save_state(path, state):
+    """Escritura atómica: el servicio de inferencia nunca ve un archivo a medias."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **{k: state[k] for k in _KEYS})
+    os.replace(tmp, path)
+
+def centroid_matrix(state):
+    """Devuelve (ids de estándar, matriz de centroides float32)."""
+    counts = np.maximum(state["counts"], 1)[:, None]
+    return state["est_ids"].tolist(), (state["sums"] / counts).astype(np.float32)
+
+def update_state(state, df, encode):
+    """
+    Sincroniza el estado con `df` (id_pregunta, enunciado, id_estandar):
+    codifica solo ítems nuevos o modificados y resta los eliminados.
+    `encode(textos)` debe devolver embeddings normalizados.
+    Devuelve (nuevo_estado, {"added", "changed", "removed"}).
+    """
+    dim = state["sums"].shape[1]
+    # un id_pregunta repetido se contaría dos veces y solo se restaría una
+    df = df.drop_duplicates("id_pregunta", keep="last")
+    pids = df["id_pregunta"].astype(np.int64).tolist()
+    ests = df["id_estandar"].astype(str).tolist()
+    textos = df["enunciado"].tolist()
+    hashes = [text_hash(t) for t in textos]
+
+    sums = {e: s.copy() for e, s in zip(state["est_ids"].tolist(), state["sums"])}
+    counts = dict(zip(state["est_ids"].tolist(), state["counts"].tolist()))
+    old = {int(p): i for i, p in enumerate(state["item_ids"].tolist())}
+
+    fresh, drop, seen = [], [], set()
+    n_changed = 0
+    for j, (pid, est, h) in enumerate(zip(pids, ests, hashes)):
+        seen.add(pid)
+        i = old.get(pid)
+        if i is None:
+            fresh.append(j)
+        elif state["item_hash"][i] != h or state["item_est"][i] != est:
+            drop.append(i)
+            fresh.append(j)
+            n_changed += 1
+    n_removed = 0
+    for pid, i in old.items():
+        if pid not in seen:
+            drop.append(i)
+            n_removed += 1
+
+    for i in drop:
+        est = str(state["item_est"][i])
+        sums[est] -= state["item_embs"][i]
+        counts[est] -= 1
+
+    if fresh:
+        new_embs = np.asarray(encode([textos[j] for j in fresh]), dtype=np.float32)
+    else:
+        new_embs = np.zeros((0, dim), dtype=np.float32)
+    for j, vec in zip(fresh, new_embs):
+        est = ests[j]
+        if est not in sums:
+            sums[est] = np.zeros(dim, dtype=np.float64)
+            counts[est] = 0
+        sums[est] += vec
+        counts[est] += 1
+
+    keep = np.ones(len(state["item_ids"]), dtype=bool)
+    keep[drop] = False
+    est_ids = sorted(e for e, c in counts.items() if c > 0)
+
+    new_state = {
+        "embedder_name": state["embedder_name"],
+        "est_ids": np.array(est_ids, dtype=str),
+        "sums": np.array([sums[e] for e in est_ids], dtype=np.float64).reshape(len(est_ids), dim),
+        "counts": np.array([counts[e] for e in est_ids], dtype=np.int64),
+        "item_ids": np.concatenate([state["item_ids"][keep], np.array([pids[j] for j in fresh], dtype=np.int64)]),
+        "item_est": np.concatenate([state["item_est"][keep], np.array([ests[j] for j in fresh], dtype=str)]),
+        "item_hash": np.concatenate([state["item_hash"][keep], np.array([hashes[j] for j in fresh], dtype=str)]),
+        "item_embs": np.concatenate([state["item_embs"][keep], new_embs]),
+    }
+    stats = {"added": len(fresh) - n_changed, "changed": n_changed, "removed": n_removed}
+    return new_state, stats
@@ -0,0 +1,88 @@
+# ia/utils/curriculum.py
+import threading
+import numpy as np
+from sqlalchemy import text
+
+from .schema import find_table, find_column
+
+# Jerarquía ESTANDAR → TEMA → AREA → materia en arreglos densos indexados por id.
+# Se carga una vez y se refresca en /retrain o bajo demanda.
+_curriculum = None
+_lock = threading.Lock()
+
+def _dense(ids, values, fill, dtype):
+    ids = np.asarray(ids, dtype=np.int64)
+    out = np.full(int(ids.max()) + 1 if ids.size else 0, fill, dtype=dtype)
+    out[ids] = values
+    return out
+
+def _take(arr, ids, fill):
+    """arr[ids] con `fill` para ids fuera de rango o negativos."""
+    ids = np.asarray(ids, dtype=np.int64)
+    ok = (ids >= 0) & (ids < arr.size)
+    out = np.full(ids.shape, fill, dtype=arr.dtype)
+    out[ok] = arr[ids[ok]]
+    return out
+
+def load_curriculum(engine):
+    with engine.connect() as con:
+        e, t, a = (find_table(con, n) for n in ("estandar", "tema", "area"))
+        faltan = [n for n, v in {"estandar": e, "tema": t, "area": a}.items() if not v]
+        if faltan:
+            raise RuntimeError(f"Faltan tablas: {', '.join(faltan)}")
+        col = lambda tbl, c: find_column(con, tbl, c) or c
+        q = f'''
+            SELECT e."{col(e, "id_estandar")}", e."{col(e, "valor")}", t."{col(t, "id_tema")}",
+                   a."{col(a, "id_area")}", a."{col(a, "id_materia")}"
+            FROM "{e}" e
+            JOIN "{t}" t ON e."{col(e, "id_tema")}" = t."{col(t, "id_tema")}"
+            JOIN "{a}" a ON t."{col(t, "id_area")}" = a."{col(a, "id_area")}"
+        '''
+        rows = [r for r in con.execute(text(q)) if r[0] is not None and r[4] is not None]
+
+    if rows:
+        id_est, valor, id_tema, id_area, id_materia = (np.array(c) for c in zip(*rows))
+    else:
+        id_est = id_tema = id_area = id_materia = np.zeros(0, dtype=np.int64)
+        valor = np.zeros(0, dtype=np.float64)
+    valor = np.array([np.nan if v is None else float(v) for v in valor], dtype=np.float64)
+    id_materia = id_materia.astype(np.int64)
+
+    n_mat = int(id_materia.max()) + 1 if id_materia.size else 0
+    vmin = np.full(n_mat, np.inf)
+    vmax = np.full(n_mat, -np.inf)
+    np.fmin.at(vmin, id_materia, valor)
+    np.fmax.at(vmax, id_materia, valor)
+
+    return {
+        "estandar_valor": _dense(id_est, valor, np.nan, np.float64),
+        "estandar_tema": _dense(id_est, id_tema, -1, np.int64),
+        "estandar_materia": _dense(id_est, id_materia, -1, np.int64),
+        "tema_area": _dense(id_tema, id_area, -1, np.int64),
+        "area_materia": _dense(id_area, id_materia, -1, np.int64),
+        "materia_min": vmin,
+        "materia_max": vmax,
+        "n_estandares": int(len(id_est)),
+    }
+
+def get_curriculum(engine, refresh=False):
+    global _curriculum
+    if _curriculum is None or refresh:
+        with _lock:
+            if _curriculum is None or refresh:
+                _curriculum = load_curriculum(engine)
+    return _curriculum
+
+def refresh_curriculum(engine):
+    return get_curriculum(engine, refresh=True)
+
+def estandar_attrs(cur, ids):
+    """(valor, id_materia) vectorizado; NaN / -1 si el estándar no existe."""
+    return _take(cur["estandar_valor"], ids, np.nan), _take(cur["estandar_materia"], ids, -1)
+
+def materia_range(cur, id_materia):
+    """(vmin, vmax) de `valor` en la materia, o None si no hay estándares con valor."""
+    m = int(id_materia)
+    if m < 0 or m >= cur["materia_min"].size or not np.isfinite(cur["materia_min"][m]):
+        return None
+    return float(cur["materia_min"][m]), float(cur["materia_max"][m])
@@ -0,0 +1,203 @@
+# ia/utils/embcache.py
+import os, hashlib, threading, fcntl
+from collections import OrderedDict
+import numpy as np
+
+from .encoding import encode_texts
+
+# LRU en memoria (nº de vectores) y nivel opcional en disco (memmap, persiste entre reinicios)
+EMB_CACHE_SIZE = int(os.getenv("EMB_CACHE_SIZE", "4096"))
+EMB_CACHE_DIR = os.getenv("EMB_CACHE_DIR", "")
+EMB_CACHE_DISK_ITEMS = int(os.getenv("EMB_CACHE_DISK_ITEMS", "50000"))
+
+_INDEX_DTYPE = np.dtype([("key", "S40"), ("seq", "<i8")])
+
+def cache_key(model_name: str, texto: str) -> str:
+    """Clave por contenido: sha1(modelo + texto) en hex."""
+    return hashlib.sha1(f"{model_name}\0{texto}".encode("utf-8")).hexdigest()
+
+class _DiskTier:
+    """
+    Anillo de `capacity` vectores en un memmap float32 + índice (clave, secuencia).
+    Un solo proceso escribe: el que obtiene flock exclusivo sobre el .idx; los demás
+    abren en solo lectura y validan la clave del slot después de leer el vector.
+    """
+    def __init__(self, directory, model_name, dim, capacity):
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, hashlib.sha1(model_name.encode("utf-8")).hexdigest()[:12] + f"-{dim}")
+        vec_path, idx_path = base + ".vec", base + ".idx"
+        self._lock_file = open(idx_path, "a+b")
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.writable = True
+        except OSError:
+            self.writable = False
+        fresh = not os.path.exists(vec_path) or \
+            os.path.getsize(vec_path) != capacity * dim * 4 or \
+            os.path.getsize(idx_path) != capacity * _INDEX_DTYPE.itemsize
+        if fresh and not self.writable:
+            self._lock_file.close()
+            raise OSError(f"{idx_path} lo está escribiendo otro proceso y aún no está inicializado")
+        mode = "w+" if fresh else ("r+" if self.writable else "r")
+        self.vecs = np.memmap(vec_path, dtype=np.float32, mode=mode, shape=(capacity, dim))
+        self.index = np.memmap(idx_path, dtype=_INDEX_DTYPE, mode=mode, shape=(capacity,))
+        self.capacity = capacity
+        used = np.flatnonzero((self.index["seq"] > 0) & (self.index["key"] != b""))
+        self.rows = {self.index["key"][i].decode("ascii"): int(i) for i in used}
+        if used.size:
+            last = int(used[np.argmax(self.index["seq"][used])])
+            self.seq = int(self.index["seq"][last])
+            self.next = (last + 1) % capacity
+        else:
+            self.seq, self.next = 0, 0
+
+    def get(self, key):
+        i = self.rows.get(key)
+        if i is None:
+            return None
+        vec = np.array(self.vecs[i])
+        # el slot pudo reutilizarse (otro proceso escritor): se valida después de leer
+        rec = self.index[i]
+        if rec["seq"] == 0 or rec["key"].decode("ascii") != key:
+            self.rows.pop(key, None)
+            return None
+        return vec
+
+    def put_many(self, items):
+        if not self.writable:
+            return
+        new, pending = [], set()
+        for key, vec in items:
+            if key not in self.rows and key not in pending:
+                pending.add(key)
+                new.append((key, vec))
+        new = new[-self.capacity:]
+        if not new:
+            return
+        slots = [(self.next + k) % self.capacity for k in range(len(new))]
+        # 1) invalidar los slots a reutilizar antes de tocar sus vectores; así un
+        #    corte a mitad nunca deja una clave vieja apuntando a un vector nuevo
+        for i in slots:
+            old = self.index[i]
+            if old["seq"] > 0:
+                self.rows.pop(old["key"].decode("ascii"), None)
+            self.index[i] = (b"", 0)
+        self.index.flush()
+        # 2) vectores
+        for i, (_, vec) in zip(slots, new):
+            self.vecs[i] = vec
+        self.vecs.flush()
+        # 3) claves: recién ahora las filas son visibles
+        for i, (key, _) in zip(slots, new):
+            self.seq += 1
+            self.index[i] = (key.encode("ascii"), self.seq)
+            self.rows[key] = i
+        self.index.flush()
+        self.next = (slots[-1] + 1) % self.capacity
+
+class EmbeddingCache:
+    def __init__(self, model_name, dim, max_items=EMB_CACHE_SIZE, disk_dir=EMB_CACHE_DIR, disk_items=EMB_CACHE_DISK_ITEMS):
+        self.model_name = model_name
+        self.dim = int(dim)
+        self.max_items = max(0, int(max_items))
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        if disk_dir and disk_items > 0:
+            try:
+                self._disk = _DiskTier(disk_dir, model_name, self.dim, int(disk_items))
+            except OSError as ex:
+                print("[WARN] Cache de embeddings en disco deshabilitado:", ex)
+        self.hits = self.disk_hits = self.misses = 0
+
+    def _remember(self, key, vec):
+        if self.max_items == 0:
+            return
+        self._mem[key] = vec
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    def get_many(self, texts):
+        """Lista alineada con `texts`: vector cacheado o None."""
+        keys = [cache_key(self.model_name, t) for t in texts]
+        out = []
+        with self._lock:
+            for key in keys:
+                vec = self._mem.get(key)
+                if vec is not None:
+                    self._mem.move_to_end(key)
+                    self.hits += 1
+                elif self._disk is not None and (vec := self._disk.get(key)) is not None:
+                    self._remember(key, vec)
+                    self.hits += 1
+                    self.disk_hits += 1
+                else:
+                    self.misses += 1
+                out.append(vec)
+        return out
+
+    def put_many(self, texts, vecs):
+        items = [(cache_key(self.model_name, t), np.asarray(v, dtype=np.float32)) for t, v in zip(texts, vecs)]
+        with self._lock:
+            for key, vec in items:
+                self._remember(key, vec)
+            if self._disk is not None:
+                self._disk.put_many(items)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "model": self.model_name,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "mem_items": len(self._mem),
+            "disk_items": len(self._disk.rows) if self._disk is not None else None,
+            "disk_writable": self._disk.writable if self._disk is not None else None,
+        }
+
+# Un cache por modelo, compartido por todo el proceso
+_caches: dict[str, EmbeddingCache] = {}
+_caches_lock = threading.Lock()
+
+def get_embedding_cache(model_name, dim):
+    with _caches_lock:
+        cache = _caches.get(model_name)
+        if cache is None:
+            cache = _caches[model_name] = EmbeddingCache(model_name, dim)
+    return cache
+
+def cache_stats():
+    with _caches_lock:
+        return [c.stats() for c in _caches.values()]
+
+def model_cache_name(model) -> str:
+    """
+    Identidad del modelo para la clave: origen desde el que se cargó (name_or_path
+    del tokenizer) + dimensión de salida. Sin origen conocido hay que pasar model_name.
+    """
+    src = getattr(getattr(model, "tokenizer", None), "name_or_path", None)
+    if not src:
+        raise ValueError("No se puede identificar el modelo; pasa model_name explícito")
+    return f"{src}:{model.get_sentence_embedding_dimension()}"
+
+def encode_cached(model, texts, model_name=None, batch_size=None, workers=None, progress=False):
+    """
+    Como encode_texts (embeddings normalizados, orden original), pero solo
+    pasa por el transformer los textos que no están en cache.
+    """
+    texts = ["" if t is None else str(t) for t in texts]
+    model_name = model_name or model_cache_name(model)
+    cache = get_embedding_cache(model_name, model.get_sentence_embedding_dimension())
+    found = cache.get_many(texts)
+    missing = list(dict.fromkeys(t for t, v in zip(texts, found) if v is None))
+    if missing:
+        vecs = encode_texts(model, missing, batch_size=batch_size, workers=workers, progress=progress)
+        cache.put_many(missing, vecs)
+        new = dict(zip(missing, vecs))
+        found = [new[t] if v is None else v for t, v in zip(texts, found)]
+    if not found:
+        return np.zeros((0, cache.dim), dtype=np.float32)
+    return np.stack(found).astype(np.float32, copy=False)
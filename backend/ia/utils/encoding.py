@@ -0,0 +1,122 @@
+# ia/utils/encoding.py
+import os, time
+from contextlib import contextmanager
+import numpy as np
+
+# Tamaño de lote por defecto y nº de procesos (0 = automático, ver _resolve_workers)
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", "64"))
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", "0"))
+# Tope de procesos en modo automático: cada uno carga su propia copia del modelo
+ENCODE_MAX_AUTO_WORKERS = 4
+# Hilos de torch mínimos por proceso en modo automático
+_MIN_THREADS_PER_WORKER = 4
+# Por debajo de este nº de textos no compensa levantar el pool de procesos
+ENCODE_POOL_MIN = int(os.getenv("ENCODE_POOL_MIN", "512"))
+
+def _resolve_workers(workers):
+    if workers is None:
+        workers = ENCODE_WORKERS
+    if workers <= 0:
+        # Conservador: un proceso por cada 4 núcleos, máx. 4. Con menos de 8
+        # núcleos queda en 1 (sin pool) y torch paraleliza dentro del proceso.
+        workers = min(ENCODE_MAX_AUTO_WORKERS, (os.cpu_count() or 1) // _MIN_THREADS_PER_WORKER)
+    return max(1, int(workers))
+
+@contextmanager
+def _worker_threads(workers):
+    """
+    Reparte los núcleos entre los procesos hijos: se lanzan con spawn y torch lee
+    OMP_NUM_THREADS al importarse, así no hay núcleos² hilos compitiendo.
+    """
+    n = str(max(1, (os.cpu_count() or 1) // workers))
+    keys = ("OMP_NUM_THREADS", "MKL_NUM_THREADS")
+    old = {k: os.environ.get(k) for k in keys}
+    os.environ.update({k: n for k in keys})
+    try:
+        yield
+    finally:
+        for k, v in old.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+def token_lengths(model, texts):
+    """Longitud en tokens (truncada a max_seq_length) de cada texto."""
+    tok = getattr(model, "tokenizer", None)
+    if tok is None:
+        return np.array([len(t) for t in texts], dtype=np.int64)
+    enc = tok(
+        list(texts),
+        add_special_tokens=True,
+        truncation=True,
+        max_length=model.max_seq_length,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+    )
+    return np.array([len(ids) for ids in enc["input_ids"]], dtype=np.int64)
+
+def length_buckets(lengths, batch_size):
+    """
+    Ordena por longitud y parte en lotes contiguos de textos de tamaño parecido.
+    Devuelve (orden, [slices sobre el orden]).
+    """
+    order = np.argsort(lengths, kind="stable")
+    n = len(order)
+    bounds = [slice(i, min(i + batch_size, n)) for i in range(0, n, batch_size)]
+    return order, bounds
+
+def _normalize(vecs):
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vecs / norms
+
+def _log_progress(done, total, t0):
+    dt = max(time.time() - t0, 1e-9)
+    print(f"[INFO] Embeddings {done}/{total} ({done / dt:.1f} textos/s)")
+
+def encode_texts(model, texts, batch_size=None, workers=None, normalize=True, progress=False):
+    """
+    Codifica `texts` agrupando por longitud en tokens para minimizar el padding
+    y, si hay suficientes textos, reparte el trabajo en un pool de procesos CPU.
+    Devuelve un np.ndarray float32 alineado con el orden original de `texts`.
+    """
+    texts = ["" if t is None else str(t) for t in texts]
+    n = len(texts)
+    dim = model.get_sentence_embedding_dimension()
+    if n == 0:
+        return np.zeros((0, dim), dtype=np.float32)
+
+    batch_size = max(1, int(batch_size or ENCODE_BATCH_SIZE))
+    workers = _resolve_workers(workers)
+
+    order, bounds = length_buckets(token_lengths(model, texts), batch_size)
+    sorted_texts = [texts[i] for i in order]
+    out = np.empty((n, dim), dtype=np.float32)
+    t0 = time.time()
+
+    if workers > 1 and n >= ENCODE_POOL_MIN:
+        # Cada llamada reparte un tramo ordenado entre los procesos; los trozos
+        # son múltiplos del lote para que cada lote siga siendo homogéneo.
+        chunk = batch_size * max(1, int(np.ceil(n / (workers * batch_size * 4))))
+        step = chunk * workers
+        with _worker_threads(workers):
+            pool = model.start_multi_process_pool(target_devices=["cpu"] * workers)
+        try:
+            for i in range(0, n, step):
+                part = sorted_texts[i:i + step]
+                vecs = model.encode_multi_process(part, pool, batch_size=batch_size, chunk_size=chunk)
+                out[order[i:i + len(part)]] = vecs
+                if progress:
+                    _log_progress(i + len(part), n, t0)
+        finally:
+            model.stop_multi_process_pool(pool)
+    else:
+        every = max(1, len(bounds) // 10)
+        for b, sl in enumerate(bounds):
+            vecs = model.encode(sorted_texts[sl], batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+            out[order[sl]] = vecs
+            if progress and ((b + 1) % every == 0 or b + 1 == len(bounds)):
+                _log_progress(sl.stop, n, t0)
+
+    return _normalize(out) if normalize else out
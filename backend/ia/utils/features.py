@@ -1,23 +1,29 @@
 # ia/utils/features.py
-import os, json
+import os, json, threading, time
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 from sqlalchemy import text
 from sentence_transformers import SentenceTransformer
 from sklearn.linear_model import Ridge
 
+from .embcache import encode_cached
+from .curriculum import get_curriculum, estandar_attrs, materia_range
+from .schema import find_table, find_column
+
+SENTENCE_MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
 _model_cache = None
 
 def get_sentence_model():
     global _model_cache
     if _model_cache is None:
         # Modelo multilingüe liviano
-        _model_cache = SentenceTransformer("sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+        _model_cache = SentenceTransformer(SENTENCE_MODEL_NAME)
     return _model_cache
 
-def embed_texts(model, texts):
-    vecs = model.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
-    return np.array(vecs)
+def embed_texts(model, texts, model_name:str|None=None):
+    # sin model_name la clave de cache se deriva del propio modelo
+    return encode_cached(model, texts, model_name)
 
 def load_or_fit_regressor(X, y):
     # Ridge sencillo; puedes cambiar a otra regresión
@@ -47,51 +53,93 @@ def fetch_questions_by_estandar(engine, id_estandar:int):
       df = pd.read_sql(text(sql), con, params={"e": id_estandar})
     return df
 
-def fetch_unseen_questions(engine, id_evaluacion:int, ids:list[int]):
-    if not ids:
+# Nombres reales (case-insensitive) de las tablas usadas aquí; no cambian en caliente
+_names: dict[str, dict[str, str]] = {}
+
+def _table_names(con, base:str, cols:tuple[str, ...]) -> dict[str, str]:
+    """{"table": nombre real, <col>: nombre real} para `base`, resuelto una vez."""
+    names = _names.get(base)
+    if names is None:
+        table = find_table(con, base)
+        if not table:
+            raise RuntimeError(f"Faltan tablas: {base}")
+        names = {"table": table, **{c: find_column(con, table, c) or c for c in cols}}
+        _names[base] = names
+    return names
+
+# Cache opcional (opt-in) de preguntas ya mostradas por evaluación: LRU acotado con TTL.
+# Las respuestas las escribe el backend Node en Detalle_evaluacion, así que el cache
+# solo ve lo que pasa por mark_question_seen; el TTL acota cuánto puede atrasarse.
+SEEN_CACHE_MAX = int(os.getenv("SEEN_CACHE_MAX", "1024"))
+SEEN_CACHE_TTL_S = float(os.getenv("SEEN_CACHE_TTL_S", "60"))
+_seen_cache: "OrderedDict[int, tuple[float, np.ndarray]]" = OrderedDict()
+_seen_lock = threading.Lock()
+
+def seen_question_ids(engine, id_evaluacion:int, refresh:bool=False) -> np.ndarray:
+    """Ids de Detalle_evaluacion para la evaluación; se reconsulta al vencer el TTL."""
+    ev = int(id_evaluacion)
+    now = time.monotonic()
+    with _seen_lock:
+        cached = _seen_cache.get(ev)
+        if cached is not None and not refresh and now - cached[0] < SEEN_CACHE_TTL_S:
+            _seen_cache.move_to_end(ev)
+            return cached[1]
+    with engine.connect() as con:
+      d = _table_names(con, "detalle_evaluacion", ("id_evaluacion", "id_pregunta"))
+      sql = f'SELECT "{d["id_pregunta"]}" FROM "{d["table"]}" WHERE "{d["id_evaluacion"]}" = :ev'
+      ids = np.unique(np.array([r[0] for r in con.execute(text(sql), {"ev": ev})], dtype=np.int64))
+    with _seen_lock:
+        _seen_cache[ev] = (now, ids)
+        _seen_cache.move_to_end(ev)
+        while len(_seen_cache) > SEEN_CACHE_MAX:
+            _seen_cache.popitem(last=False)
+    return ids
+
+def mark_question_seen(id_evaluacion:int, id_pregunta:int):
+    """Agrega una pregunta al conjunto cacheado (solo si la evaluación ya está cargada)."""
+    ev = int(id_evaluacion)
+    with _seen_lock:
+        cur = _seen_cache.get(ev)
+        if cur is not None:
+            _seen_cache[ev] = (cur[0], np.union1d(cur[1], np.array([int(id_pregunta)], dtype=np.int64)))
+
+def forget_evaluation(id_evaluacion:int):
+    with _seen_lock:
+        _seen_cache.pop(int(id_evaluacion), None)
+
+def fetch_unseen_questions(engine, id_evaluacion:int, ids:list[int], use_cache:bool=False):
+    if ids is None or len(ids) == 0:
         return pd.DataFrame(columns=["id_pregunta"])
-    sql = """
-      SELECT q.id_pregunta
-      FROM (SELECT UNNEST(:ids)::int AS id_pregunta) q
-      WHERE q.id_pregunta NOT IN (
-        SELECT id_pregunta FROM DETALLE_EVALUACION WHERE id_evaluacion = :ev
-      )
-    """
-    # SQLAlchemy no pasa arreglos anónimos fácil a UNNEST en algunos drivers; hacemos alternativa:
-    ids_tuple = tuple(int(x) for x in ids)
-    q = f"""
-      SELECT p.id_pregunta
-      FROM PREGUNTA p
-      WHERE p.id_pregunta IN {ids_tuple if len(ids_tuple)>1 else f"({ids_tuple[0]})"}
-        AND p.id_pregunta NOT IN (
-          SELECT id_pregunta FROM DETALLE_EVALUACION WHERE id_evaluacion = {int(id_evaluacion)}
-        )
-      ORDER BY p.id_pregunta
-    """
+    arr = np.unique(np.asarray(ids, dtype=np.int64))
+    if use_cache:
+        # filtrado en memoria contra el conjunto cacheado (puede atrasarse hasta SEEN_CACHE_TTL_S)
+        seen = seen_question_ids(engine, id_evaluacion)
+        return pd.DataFrame({"id_pregunta": arr[~np.isin(arr, seen, assume_unique=True)]})
+    # arreglo como parámetro ligado + anti-join: plan estable sin importar cuántos ids
     with engine.connect() as con:
-      df = pd.read_sql(q, con)
+      p = _table_names(con, "pregunta", ("id_pregunta",))
+      d = _table_names(con, "detalle_evaluacion", ("id_evaluacion", "id_pregunta"))
+      sql = f"""
+        SELECT p."{p["id_pregunta"]}" AS id_pregunta
+        FROM UNNEST(CAST(:ids AS int[])) AS q(id_pregunta)
+        JOIN "{p["table"]}" p ON p."{p["id_pregunta"]}" = q.id_pregunta
+        WHERE NOT EXISTS (
+          SELECT 1 FROM "{d["table"]}" d
+          WHERE d."{d["id_evaluacion"]}" = :ev AND d."{d["id_pregunta"]}" = q.id_pregunta
+        )
+        ORDER BY 1
+      """
+      df = pd.read_sql(text(sql), con, params={"ids": arr.tolist(), "ev": int(id_evaluacion)})
     return df
 
 def standard_value_range(engine, id_estandar:int):
     # rango de valores dentro de la misma materia (o todo el universo)
-    sql = """
-      SELECT e.valor
-      FROM ESTANDAR e
-      JOIN TEMA t ON e.id_tema = t.id_tema
-      JOIN AREA a ON t.id_area = a.id_area
-      WHERE a.id_materia = (
-        SELECT a2.id_materia
-        FROM ESTANDAR e2
-        JOIN TEMA t2 ON e2.id_tema = t2.id_tema
-        JOIN AREA a2 ON t2.id_area = a2.id_area
-        WHERE e2.id_estandar = :e
-      )
-    """
-    with engine.connect() as con:
-      vals = [r[0] for r in con.execute(text(sql), {"e": id_estandar})]
-    if not vals:
+    cur = get_curriculum(engine)
+    _, materia = estandar_attrs(cur, [id_estandar])
+    rng = materia_range(cur, materia[0])
+    if rng is None:
         return (0.0, 1.0)
-    return (min(vals), max(vals))
+    return rng
 
 def scale_to_unit(v, vmin, vmax):
     if vmax <= vmin: return 0.5
@@ -0,0 +1,27 @@
+# ia/utils/schema.py
+import pandas as pd
+
+# Resolución case-insensitive de tablas / columnas reales del esquema public
+def list_tables(con) -> list[str]:
+    return pd.read_sql(
+        "SELECT table_name FROM information_schema.tables WHERE table_schema='public'",
+        con
+    )["table_name"].tolist()
+
+def list_columns(con, table_name: str) -> list[str]:
+    return pd.read_sql(
+        "SELECT column_name FROM information_schema.columns WHERE table_schema='public' AND table_name = %(t)s",
+        con, params={"t": table_name}
+    )["column_name"].tolist()
+
+def find_table(con, base: str) -> str | None:
+    for n in list_tables(con):
+        if n.lower() == base.lower():
+            return n
+    return None
+
+def find_column(con, table_name: str, base: str) -> str | None:
+    for c in list_columns(con, table_name):
+        if c.lower() == base.lower():
+            return c
+    return None